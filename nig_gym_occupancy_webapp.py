@@ -5,6 +5,8 @@ Created on Wed Apr 12 19:02:18 2023
 @author: Abdullah Syafiq
 """
 import datetime
+import threading
+import time
 import gspread
 import numpy as np
 import plotly.express as px
@@ -39,14 +41,50 @@ CRED_JSON = st.secrets["gcp_service_account"]
 def convert_datetime(input_df, cols):
     """Batch convert df columns dtypes to datetime"""
     for x in cols:
+        # values are written with str(datetime), which is ISO 8601 but drops
+        # the fraction when microsecond == 0, so no fixed format= is given;
+        # pandas already parses ISO 8601 strings on its vectorized C path
         input_df[x] = pd.to_datetime(input_df[x])
     return input_df
 
 
+def convert_numeric(input_df, cols):
+    """Batch convert df columns dtypes to numeric, blank cells become NaN"""
+    for x in cols:
+        input_df[x] = pd.to_numeric(input_df[x], errors="coerce")
+    return input_df
+
+
+def values_to_df(input_values):
+    """Convert worksheet values (header on the first row) into dataframe"""
+    if len(input_values) == 0:
+        return pd.DataFrame()
+    header = input_values[0]
+    # pad rows, the API omits trailing empty cells
+    rows = [row + [""] * (len(header) - len(row)) for row in input_values[1:]]
+    return pd.DataFrame.from_records(rows, columns=header)
+
+
+def empty_df(dtypes):
+    """Create empty dataframe with the given column dtypes"""
+    return pd.DataFrame({col: pd.Series(dtype=dtype) for col, dtype in dtypes.items()})
+
+
+def to_row_data(input_row):
+    """Convert a list of values into Sheets API RowData"""
+    cells = []
+    for x in input_row:
+        if isinstance(x, (int, float)):
+            cells.append({"userEnteredValue": {"numberValue": x}})
+        else:
+            cells.append({"userEnteredValue": {"stringValue": str(x)}})
+    return {"values": cells}
+
+
 def datetime_now(input_timezone_offset):
     """Get current datetime corrected to timezone, remove timezone info"""
-    now_utc = datetime.datetime.utcnow()
-    now_tz = now_utc + datetime.timedelta(hours=input_timezone_offset)
+    now_utc = pd.Timestamp.utcnow().tz_localize(None)
+    now_tz = now_utc + pd.Timedelta(hours=input_timezone_offset)
     return now_tz
 
 
@@ -126,11 +164,49 @@ def filter_dataframe(df: pd.DataFrame) -> pd.DataFrame:
     return df
 
 
+@st.cache_resource(ttl=CACHE_TTL, show_spinner=False)
+def plot_timeline(input_df):
+    """Build occupancy timeline figure, reused across reruns until df changes"""
+    # cache_resource returns the figure itself, st.plotly_chart only reads it
+    fig = px.timeline(
+        input_df,
+        x_start="start",
+        x_end="finish_estimation",
+        y="name",
+        color="name",
+        template="plotly",
+    )
+    # otherwise names are listed from the bottom up
+    fig.update_yaxes(
+        autorange="reversed",
+        # visible=False,
+        # showticklabels=False,
+        # tickfont_family='Arial Black',
+        tickfont_size=16,
+        # tickfont_color='black',
+    )
+    fig.update_layout(
+        xaxis_title="Time",
+        yaxis_title="",
+    )
+    fig.update(
+        layout_showlegend=False,
+    )
+    return fig
+
+
+@st.cache_resource(show_spinner=False)
+def load_client(_input_json):
+    """Authenticate gspread client, kept for the whole process lifetime"""
+    # gspread refreshes the access token by itself
+    return gspread.service_account_from_dict(_input_json)
+
+
 @st.cache_resource(ttl=CACHE_TTL, show_spinner="Fetching data from API...")
 def load_worksheet(input_gsheets_url, _input_json):
     """Fetch gsheet via gspread"""
     # authentication
-    gc = gspread.service_account_from_dict(_input_json)
+    gc = load_client(_input_json)
 
     # import google sheet
     sh = gc.open_by_url(input_gsheets_url)
@@ -138,59 +214,145 @@ def load_worksheet(input_gsheets_url, _input_json):
     worksheet_active_loaded = sh.worksheet("active")
     worksheet_log_loaded = sh.worksheet("log")
 
-    return worksheet_active_loaded, worksheet_log_loaded
+    return sh, worksheet_active_loaded, worksheet_log_loaded
 
 
 # %%
-worksheet_active, worksheet_log = load_worksheet(GSHEETS_URL, CRED_JSON)
-
+sh, worksheet_active, worksheet_log = load_worksheet(GSHEETS_URL, CRED_JSON)
+# sheetId for raw batch_update requests
+ACTIVE_SHEET_ID = worksheet_active.id
+LOG_SHEET_ID = worksheet_log.id
+
+
+def load_df(active_values, log_values):
+    """Process imported gsheet's worksheet values into workable dataframe"""
+    active_dtypes = {
+        "name": "object",
+        "lab": "object",
+        "start": "datetime64[ns]",
+        "finish_estimation": "datetime64[ns]",
+        "duration_estimation": "int64",
+    }
+    log_dtypes = {
+        **active_dtypes,
+        "finish_actual": "object",
+        "duration_actual": "float64",
+    }
+    cols = ["start", "finish_estimation"]
 
-@st.cache_data(ttl=CACHE_TTL, show_spinner="Processing data...")
-def load_df(_worksheet_active, _worksheet_log):
-    """Process imported gsheet's worksheet into workable dataframe"""
-    df_loaded = pd.DataFrame(worksheet_active.get_all_records())
-    # check for empty df
+    df_loaded = values_to_df(active_values)
+    # check for empty df, no need to parse anything
     if len(df_loaded.index) == 0:
-        df_loaded = pd.DataFrame(
-            columns=["name", "lab", "start", "finish_estimation", "duration_estimation"]
-        )
+        df_loaded = empty_df(active_dtypes)
+    else:
+        # parse date
+        df_loaded = convert_datetime(df_loaded, cols)
+        # values are fetched as formatted strings
+        df_loaded = convert_numeric(df_loaded, ["duration_estimation"])
 
-    log_df_loaded = pd.DataFrame(worksheet_log.get_all_records())
-    # check for empty log_df
+    log_df_loaded = values_to_df(log_values)
+    # check for empty log_df, no need to parse anything
     if len(log_df_loaded.index) == 0:
-        log_df_loaded = pd.DataFrame(
-            columns=[
-                "name",
-                "lab",
-                "start",
-                "finish_estimation",
-                "duration_estimation",
-                "finish_actual",
-                "duration_actual",
-            ]
+        log_df_loaded = empty_df(log_dtypes)
+    else:
+        log_df_loaded = convert_datetime(log_df_loaded, cols)
+        log_df_loaded = convert_numeric(
+            log_df_loaded, ["duration_estimation", "duration_actual"]
         )
 
-    cols = ["start", "finish_estimation"]
-    # parse date
-    df_loaded = convert_datetime(df_loaded, cols)
-    log_df_loaded = convert_datetime(log_df_loaded, cols)
-
     return df_loaded, log_df_loaded
 
 
-df, log_df = load_df(worksheet_active, worksheet_log)
-# %%
-# check if old entry hasn't been logged out
-current_time = datetime_now(TIMEZONE_OFFSET)
-df = df.assign(delta=current_time - df["start"])
-old_entries = df.index[df["delta"] / np.timedelta64(1, "m") > MAX_SESSION_DUR].values
+def find_old_entries(input_df):
+    """Locate entries that exceeded MAX_SESSION_DUR without logging out"""
+    current_time = datetime_now(TIMEZONE_OFFSET)
+    old_entries_mask = (current_time - input_df["start"]) > pd.Timedelta(
+        minutes=MAX_SESSION_DUR
+    )
+    return np.flatnonzero(old_entries_mask.values)
+
+
+def remove_old_entries(input_sh, input_sheet_id, input_df):
+    """Delete old entries from the active worksheet and from df"""
+    old_entries = find_old_entries(input_df)
+    if len(old_entries) == 0:
+        return input_df
+
+    # delete bottom-up in a single request so row shifts don't affect later deletes
+    requests = [
+        {
+            "deleteDimension": {
+                "range": {
+                    "sheetId": input_sheet_id,
+                    "dimension": "ROWS",
+                    "startIndex": int(entry) + 1,
+                    "endIndex": int(entry) + 2,
+                }
+            }
+        }
+        for entry in sorted(old_entries, reverse=True)
+    ]
+    input_sh.batch_update({"requests": requests})
+    # keep df in sync with the sheet
+    return input_df.drop(index=old_entries).reset_index(drop=True)
+
+
+@st.cache_resource(show_spinner=False)
+def load_sheet_store(input_gsheets_url):
+    """Latest processed worksheet dataframes, shared across all sessions"""
+    return {"data": None, "ts": 0.0, "lock": threading.Lock()}
+
+
+def is_store_fresh(input_store):
+    """Check if stored dataframes are within CACHE_TTL and have no old entries"""
+    return (
+        input_store["data"] is not None
+        and time.time() - input_store["ts"] < CACHE_TTL
+        and len(find_old_entries(input_store["data"][0])) == 0
+    )
 
-# remove old entry
-if len(old_entries) > 0:
-    for entry in old_entries:
-        worksheet_active.delete_rows(int(entry) + 2)
 
-df = df.drop(columns=["delta"])
+def fetch_df(input_gsheets_url, input_sh, input_active_sheet_id):
+    """
+    Fetch and process worksheets, refreshed at most once per CACHE_TTL
+
+    Only the first rerun past CACHE_TTL refetches, other sessions keep
+    serving the stale dataframes in the meantime instead of all hitting the API.
+    Old entries are removed under the lock before the dataframes are stored,
+    so each snapshot is cleaned exactly once.
+    """
+    store = load_sheet_store(input_gsheets_url)
+    if is_store_fresh(store):
+        return store["data"]
+
+    # only wait for the lock if there is nothing to serve yet
+    if store["lock"].acquire(blocking=store["data"] is None):
+        try:
+            # another session may have refetched while we were waiting
+            if not is_store_fresh(store):
+                with st.spinner("Fetching data from API..."):
+                    # fetch both worksheets in a single request, used columns only
+                    resp = input_sh.values_batch_get(["active!A:E", "log!A:G"])
+                    active_values, log_values = (
+                        value_range.get("values", [])
+                        for value_range in resp["valueRanges"]
+                    )
+                    # parse once per fetch, not on every rerun
+                    df_loaded, log_df_loaded = load_df(active_values, log_values)
+                    df_loaded = remove_old_entries(
+                        input_sh, input_active_sheet_id, df_loaded
+                    )
+                    store["data"] = (df_loaded, log_df_loaded)
+                store["ts"] = time.time()
+        finally:
+            store["lock"].release()
+    return store["data"]
+
+
+df, log_df = fetch_df(GSHEETS_URL, sh, ACTIVE_SHEET_ID)
+# %%
+# names currently in the gym, for membership checks
+active_names = set(df["name"].to_numpy().tolist())
 # %%
 st.title(":muscle: NIG Training Gym Occupancy  :man-lifting-weights:")
 
@@ -199,44 +361,22 @@ tab1, tab2, tab3, tab4 = st.tabs(["Home", "Login", "Logout", "Data"])
 
 with tab1:
     # show number of people currently on the room
-    st.write("**Occupancy**: ", len(df.index), "/", MAX_CAPACITY)
+    n_people = len(df)
+    st.write("**Occupancy**: ", n_people, "/", MAX_CAPACITY)
 
-    if len(df.index) > MAX_CAPACITY:
+    if n_people > MAX_CAPACITY:
         st.write("The gym is currently exceeding maximum capacity :warning:")
-    elif len(df.index) == MAX_CAPACITY:
+    elif n_people == MAX_CAPACITY:
         st.write("The gym is currently at full capacity	")
-    elif len(df.index) == 0:
+    elif n_people == 0:
         st.write("It seems like nobody is in the gym :eyes:")
     else:
         st.write("It must be fun to do some workout:sparkles:")
 
     st.divider()
     st.header("Who's in the gym? :thinking_face:")
-    if len(df.index) != 0:
-        fig = px.timeline(
-            df,
-            x_start="start",
-            x_end="finish_estimation",
-            y="name",
-            color="name",
-            template="plotly",
-        )
-        # otherwise names are listed from the bottom up
-        fig.update_yaxes(
-            autorange="reversed",
-            # visible=False,
-            # showticklabels=False,
-            # tickfont_family='Arial Black',
-            tickfont_size=16,
-            # tickfont_color='black',
-        )
-        fig.update_layout(
-            xaxis_title="Time",
-            yaxis_title="",
-        )
-        fig.update(
-            layout_showlegend=False,
-        )
+    if n_people != 0:
+        fig = plot_timeline(df[["name", "start", "finish_estimation"]])
         st.plotly_chart(fig, use_container_width=True, config = {'staticPlot': STATIC_PLOT})
     else:
         st.write(
@@ -244,8 +384,9 @@ with tab1:
         )
 
     if st.button("Refresh", key="refresh_home_btn"):
-        st.cache_data.clear()
-        st.cache_resource.clear()
+        # keep the authenticated gspread client, only drop cached data
+        load_sheet_store.clear()
+        load_worksheet.clear()
         st.experimental_rerun()
 # %%
 with tab2:
@@ -257,7 +398,7 @@ with tab2:
     name_input = st.text_input(
         "Name", label_visibility="collapsed", placeholder="Anonymous"
     )
-    if name_input in df["name"].values:
+    if name_input in active_names:
         st.write("Are you a twin?:thinking_face: Pick another name.	:nerd_face:")
 
     st.subheader("Lab")
@@ -295,7 +436,7 @@ with tab2:
         elif len(lab_input) == 0:
             st.error("Please write your lab", icon="🚨")
         # check if input name is already exist
-        elif name_input in df["name"].values:
+        elif name_input in active_names:
             st.error(
                 "Are you a twin?:thinking_face: Pick another name.	:nerd_face:",
                 icon="🚨",
@@ -308,9 +449,21 @@ with tab2:
                 str(finish_time),
                 int(dur_input),
             ]
-            # push to gsheet
-            worksheet_active.append_row(input_row, table_range="A1:E1")
-            worksheet_log.append_row(input_row, table_range="A1:E1")
+            # push to gsheet, both worksheets in a single request
+            row_data = to_row_data(input_row)
+            requests = [
+                {
+                    "appendCells": {
+                        "sheetId": sheet_id,
+                        "rows": [row_data],
+                        "fields": "userEnteredValue",
+                    }
+                }
+                for sheet_id in (ACTIVE_SHEET_ID, LOG_SHEET_ID)
+            ]
+            sh.batch_update({"requests": requests})
+            # sheet rows changed, refetch on the next rerun
+            load_sheet_store(GSHEETS_URL)["ts"] = 0.0
             # notification
             st.success("Logged in, enjoy your workout!", icon="✅")
             st.write("")
@@ -319,15 +472,18 @@ with tab2:
     if st.session_state["login"]:
         if st.button("Refresh", key="refresh_login_btn"):
             st.session_state["login"] = False
-            st.cache_data.clear()
-            st.cache_resource.clear()
+            # keep the authenticated gspread client, only drop cached data
+            load_sheet_store.clear()
+            load_worksheet.clear()
             st.experimental_rerun()
 # %%
 with tab3:
     st.header("Logout")
     st.write("My glycogen stores has been depleted")
     # name and duration input box
-    name_logout = st.selectbox("Name", options=df["name"].unique())
+    # unique names, in login order
+    options = list(dict.fromkeys(df["name"].to_numpy().tolist()))
+    name_logout = st.selectbox("Name", options=options)
 
     if len(df.index) > 0:
         # select row
@@ -337,8 +493,8 @@ with tab3:
         finish_actual = datetime_now(TIMEZONE_OFFSET)
 
         # calculate actual duration
-        start_time = pd.Timestamp(input_log_df["start"].values[0]).to_pydatetime()
-        duration_actual = int((finish_actual - start_time).total_seconds() / 60)
+        start_time = input_log_df["start"].iloc[0]
+        duration_actual = int((finish_actual - start_time) // pd.Timedelta(minutes=1))
 
         # show duration
         st.write("You have been here for", f"**{duration_actual}**", "minutes")
@@ -352,32 +508,59 @@ with tab3:
     # action on logout button click
     if st.button("Logout"):
         st.session_state["logout"] = not st.session_state["logout"]
-        # locate logout_name index in log_df
-        start_time = df["start"][df["name"] == name_logout].values[0]
-        name_logout_log_idx = (
-            log_df.index[
-                ((log_df["name"] == name_logout) & (log_df["start"] == start_time))
-            ].tolist()[0]
-            + 2
-        )
-        # update log
-        worksheet_log.update_cell(name_logout_log_idx, 6, str(finish_actual))
-        worksheet_log.update_cell(name_logout_log_idx, 7, duration_actual)
-        # remove name entry
-        name_logout_idx = df.index[df["name"] == name_logout].tolist()[0] + 2
-        worksheet_active.delete_rows(name_logout_idx)
-
-        st.success("Logged out, Thank you for using NIG Training Gym", icon="✅")
-        st.balloons()
-        st.write("")
-        st.write("")
+        # locate logout_name index in df and log_df
+        active_mask = df["name"].to_numpy() == name_logout
+        log_mask = log_df["name"].to_numpy() == name_logout
+        if active_mask.any():
+            # np.datetime64, compared against the datetime64 array directly
+            start_time = df["start"].to_numpy()[active_mask][0]
+            log_mask &= log_df["start"].to_numpy() == start_time
+        if not (active_mask.any() and log_mask.any()):
+            st.error("Name not found, please refresh", icon="🚨")
+        else:
+            name_logout_idx = int(np.argmax(active_mask)) + 2
+            name_logout_log_idx = int(np.argmax(log_mask)) + 2
+            requests = [
+                # update log, finish_actual and duration_actual columns
+                {
+                    "updateCells": {
+                        "rows": [to_row_data([str(finish_actual), duration_actual])],
+                        "fields": "userEnteredValue",
+                        "start": {
+                            "sheetId": LOG_SHEET_ID,
+                            "rowIndex": name_logout_log_idx - 1,
+                            "columnIndex": 5,
+                        },
+                    }
+                },
+                # remove name entry
+                {
+                    "deleteDimension": {
+                        "range": {
+                            "sheetId": ACTIVE_SHEET_ID,
+                            "dimension": "ROWS",
+                            "startIndex": name_logout_idx - 1,
+                            "endIndex": name_logout_idx,
+                        }
+                    }
+                },
+            ]
+            sh.batch_update({"requests": requests})
+            # sheet rows shifted, refetch on the next rerun
+            load_sheet_store(GSHEETS_URL)["ts"] = 0.0
+
+            st.success("Logged out, Thank you for using NIG Training Gym", icon="✅")
+            st.balloons()
+            st.write("")
+            st.write("")
 
     # nested refresh button
     if st.session_state["logout"]:
         if st.button("Refresh", key="refresh_logout_btn"):
             st.session_state["logout"] = False
-            st.cache_data.clear()
-            st.cache_resource.clear()
+            # keep the authenticated gspread client, only drop cached data
+            load_sheet_store.clear()
+            load_worksheet.clear()
             st.experimental_rerun()
 # %%
 with tab4: